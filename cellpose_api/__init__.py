@@ -1,2 +1,6 @@
 # Cellpose API Django Project
 
+# Load the Celery app when Django starts so shared_task uses it
+from .celery import app as celery_app
+
+__all__ = ('celery_app',)
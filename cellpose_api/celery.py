@@ -0,0 +1,14 @@
+# Celery application for Cellpose API
+import os
+
+from celery import Celery
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cellpose_api.settings')
+
+app = Celery('cellpose_api')
+
+# Read CELERY_* settings from Django settings
+app.config_from_object('django.conf:settings', namespace='CELERY')
+
+# Discover tasks.py in installed apps
+app.autodiscover_tasks()
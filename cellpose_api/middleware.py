@@ -0,0 +1,16 @@
+# Middleware for Cellpose API
+from django.middleware.gzip import GZipMiddleware
+
+
+class APIGZipMiddleware(GZipMiddleware):
+    """GZip JSON responses but pass result file downloads through untouched
+    
+    Downloads are streamed FileResponses of PNG, ZIP and npz files that are
+    already compressed, and compressing a stream would also drop its
+    Content-Length.
+    """
+    
+    def process_response(self, request, response):
+        if response.streaming:
+            return response
+        return super().process_response(request, response)
@@ -24,6 +24,7 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'cellpose_api.middleware.APIGZipMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -96,7 +97,29 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 # Cellpose specific settings
 CELLPOSE_MODEL_PATH = os.environ.get('CELLPOSE_MODEL_PATH', 'cpsam')
 CELLPOSE_DEVICE = os.environ.get('CELLPOSE_DEVICE', 'cpu')  # or 'cuda'
+CELLPOSE_USE_BFLOAT16 = os.environ.get('CELLPOSE_USE_BFLOAT16', 'True').lower() == 'true'  # False for float32
 MODAL_ENDPOINT_URL = os.environ.get('MODAL_ENDPOINT_URL', 'https://your-modal-endpoint.com')
+# Hosts jobs may send completion callbacks to, e.g. '.modal.run'; empty disables callbacks
+CELLPOSE_CALLBACK_ALLOWED_HOSTS = [
+    host.strip() for host in os.environ.get('CELLPOSE_CALLBACK_ALLOWED_HOSTS', '').split(',') if host.strip()
+]
+CELLPOSE_LONG_POLL_MAX_WAITERS = int(os.environ.get('CELLPOSE_LONG_POLL_MAX_WAITERS', 4))  # /wait/ requests per process
+CELLMETRICS_BULK_BATCH_SIZE = int(os.environ.get('CELLMETRICS_BULK_BATCH_SIZE', 500))  # rows per INSERT
+
+# Celery task queue
+CELERY_BROKER_URL = os.environ.get('CELERY_BROKER_URL', 'redis://localhost:6379/0')
+CELERY_TASK_ALWAYS_EAGER = os.environ.get('CELERY_TASK_ALWAYS_EAGER', 'False').lower() == 'true'
+CELERY_TASK_IGNORE_RESULT = True
+# Give up quickly when the broker is down so job creation can answer 503
+CELERY_TASK_PUBLISH_RETRY_POLICY = {'max_retries': 2, 'interval_start': 0, 'interval_step': 0.2}
+CELERY_BROKER_CONNECTION_TIMEOUT = 2
+CELERY_TASK_ACKS_LATE = True
+CELERY_TASK_ROUTES = {
+    'cellpose_predictions.run_prediction': {'queue': 'gpu'},
+}
+# One job at a time per GPU worker, so jobs never compete for device memory
+CELERY_WORKER_CONCURRENCY = int(os.environ.get('CELERY_WORKER_CONCURRENCY', 1))
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
 
 # Logging
 LOGGING = {
@@ -23,6 +23,7 @@ class PredictionJob(models.Model):
     flow_threshold = models.FloatField(default=0.4)
     cellprob_threshold = models.FloatField(default=0.0)
     min_size = models.IntegerField(default=15)
+    callback_url = models.URLField(null=True, blank=True)  # POSTed to when the job finishes
     
     # Job status
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
@@ -42,6 +43,10 @@ class PredictionJob(models.Model):
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status']),
+            models.Index(fields=['-created_at']),
+        ]
     
     def __str__(self):
         return f"Prediction Job {self.id} - {self.status}"
@@ -1,5 +1,34 @@
 from rest_framework import serializers
 from .models import PredictionJob, CellMetrics
+from .services import check_callback_url
+
+try:
+    import magic
+    MAGIC_ENABLED = True
+except ImportError:  # python-magic or the libmagic library is not installed
+    MAGIC_ENABLED = False
+
+ALLOWED_MIME_TYPES = {'image/png', 'image/jpeg', 'image/tiff'}
+
+# File signatures checked when libmagic is not available
+IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'II*\x00', 'image/tiff'),
+    (b'MM\x00*', 'image/tiff'),
+    (b'II+\x00', 'image/tiff'),  # BigTIFF
+    (b'MM\x00+', 'image/tiff'),
+)
+
+
+def sniff_mime_type(head):
+    """Detect the MIME type of a file from its first bytes"""
+    if MAGIC_ENABLED:
+        return magic.from_buffer(head, mime=True)
+    for signature, mime_type in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return mime_type
+    return None
 
 
 class CellMetricsSerializer(serializers.ModelSerializer):
@@ -35,6 +64,15 @@ class PredictionJobSerializer(serializers.ModelSerializer):
         ]
 
 
+class PredictionJobBundleSerializer(PredictionJobSerializer):
+    """Job results without per-cell metrics, which the bundle paginates"""
+    
+    cell_metrics = None
+    
+    class Meta(PredictionJobSerializer.Meta):
+        fields = [f for f in PredictionJobSerializer.Meta.fields if f != 'cell_metrics']
+
+
 class PredictionJobCreateSerializer(serializers.ModelSerializer):
     """Serializer for creating prediction jobs"""
     
@@ -42,7 +80,7 @@ class PredictionJobCreateSerializer(serializers.ModelSerializer):
         model = PredictionJob
         fields = [
             'input_image', 'model_type', 'diameter', 'flow_threshold',
-            'cellprob_threshold', 'min_size'
+            'cellprob_threshold', 'min_size', 'callback_url'
         ]
     
     def validate_input_image(self, value):
@@ -57,6 +95,25 @@ class PredictionJobCreateSerializer(serializers.ModelSerializer):
                 f"Unsupported file format. Allowed formats: {', '.join(allowed_extensions)}"
             )
         
+        # Check file content, the extension alone can be wrong
+        value.seek(0)
+        head = value.read(2048)
+        value.seek(0)
+        mime_type = sniff_mime_type(head)
+        if mime_type not in ALLOWED_MIME_TYPES:
+            raise serializers.ValidationError(
+                f"File content is not a PNG, JPEG or TIFF image (detected {mime_type or 'unknown'})."
+            )
+        
+        return value
+    
+    def validate_callback_url(self, value):
+        """Only allow callbacks to configured public hosts"""
+        if value:
+            try:
+                check_callback_url(value)
+            except ValueError as e:
+                raise serializers.ValidationError(str(e))
         return value
 
 
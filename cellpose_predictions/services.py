@@ -1,15 +1,25 @@
 import os
 import time
+import threading
+import socket
+import ipaddress
+from urllib.parse import urlsplit
 import numpy as np
 import cv2
 import tifffile
 import zipfile
+import tempfile
+from contextlib import contextmanager
 from io import BytesIO
+from django.core.files import File
 from django.core.files.base import ContentFile
 from django.conf import settings
+from django.db import connection, transaction
+from django.http.request import validate_host
+from scipy import ndimage
 from skimage import measure
-from skimage.segmentation import find_boundaries
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import logging
 
@@ -21,31 +31,171 @@ from .models import PredictionJob, CellMetrics
 
 logger = logging.getLogger(__name__)
 
+# Region properties stored in CellMetrics
+CELL_METRIC_PROPERTIES = (
+    'label', 'area', 'perimeter', 'centroid', 'eccentricity', 'solidity',
+    'extent', 'bbox', 'equivalent_diameter_area', 'axis_major_length',
+    'axis_minor_length',
+)
+
+# Region properties returned by MetricsService.get_cell_shape_analysis
+SHAPE_ANALYSIS_PROPERTIES = (
+    'label', 'area', 'perimeter', 'eccentricity', 'solidity', 'extent',
+    'equivalent_diameter_area', 'orientation', 'axis_major_length',
+    'axis_minor_length', 'area_convex', 'area_filled', 'euler_number',
+)
+
+# Rows per stripe when rendering the segmentation overlay
+OVERLAY_TILE_ROWS = 1024
+
+# Shared keep-alive session for outbound result notifications
+_modal_session = requests.Session()
+_modal_session.mount('https://', HTTPAdapter(pool_connections=10, pool_maxsize=10))
+_modal_session.mount('http://', HTTPAdapter(pool_connections=10, pool_maxsize=10))
+
+# Separate session for per-job callbacks, which go to user-supplied hosts
+_callback_session = requests.Session()
+_callback_session.trust_env = False  # no proxies or netrc credentials from the environment
+
+
+def check_callback_url(url):
+    """Raise ValueError unless url may receive job completion callbacks
+    
+    The host must match CELLPOSE_CALLBACK_ALLOWED_HOSTS (same syntax as
+    ALLOWED_HOSTS) and resolve to public addresses only, so callbacks can
+    not be aimed at loopback, private, link-local or metadata services.
+    """
+    parts = urlsplit(url)
+    host = (parts.hostname or '').lower()
+    if parts.scheme not in ('http', 'https') or not host:
+        raise ValueError("Callback URL must be an http or https URL")
+    if not validate_host(host, settings.CELLPOSE_CALLBACK_ALLOWED_HOSTS):
+        raise ValueError(f"Callbacks to {host} are not allowed")
+    
+    port = parts.port or (443 if parts.scheme == 'https' else 80)
+    try:
+        addresses = socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)
+    except socket.gaierror:
+        raise ValueError(f"Cannot resolve callback host {host}")
+    for address in addresses:
+        ip = ipaddress.ip_address(address[4][0].split('%')[0])
+        if not ip.is_global:
+            raise ValueError(f"Callback host {host} resolves to a non-public address")
+
+
+# Process-wide CellposeService, see get_cellpose_service()
+_service_singleton = None
+_service_lock = threading.Lock()
+
+
+def get_cellpose_service():
+    """Return the process-wide CellposeService, creating it on first call"""
+    global _service_singleton
+    if _service_singleton is None:
+        with _service_lock:
+            if _service_singleton is None:
+                _service_singleton = CellposeService()
+    return _service_singleton
+
+
+def _aspect_ratio(table):
+    """Major / minor axis length per cell, 0 where the minor axis is 0"""
+    major = table['axis_major_length']
+    minor = table['axis_minor_length']
+    return np.divide(major, minor, out=np.zeros_like(major), where=minor > 0)
+
+
+def load_masks(file):
+    """Load masks saved by CellposeService (.npz, or .npy from older jobs)"""
+    data = np.load(file)
+    if isinstance(data, np.ndarray):
+        return data
+    with data:
+        return data['masks']
+
+
+def _cell_ids(masks):
+    """Sorted labels present in masks, excluding background (0)"""
+    # bincount is a single O(pixels) pass, unlike the sort in np.unique
+    cell_ids = np.flatnonzero(np.bincount(masks.ravel()))
+    return cell_ids[cell_ids > 0]
+
+
+def _outer_boundaries(masks):
+    """Boundaries of 2D label masks, same as find_boundaries(mode='outer')
+    
+    Compares each pixel with its neighbors using shifted array views: a
+    pixel is on a boundary if a 4-neighbor has a different label, and it
+    is either background or has an 8-neighbor in another object.
+    """
+    Ly, Lx = masks.shape
+    thick = np.zeros(masks.shape, dtype=bool)
+    touching = np.zeros(masks.shape, dtype=bool)
+    for dy, dx in ((0, 1), (1, 0), (1, 1), (1, -1)):
+        # Each pixel p paired with its neighbor q at offset (dy, dx)
+        p = (slice(0, Ly - dy), slice(max(0, -dx), Lx - max(0, dx)))
+        q = (slice(dy, Ly), slice(max(0, dx), Lx - max(0, -dx)))
+        differ = masks[p] != masks[q]
+        if dy == 0 or dx == 0:
+            thick[p] |= differ
+            thick[q] |= differ
+        touching[p] |= differ & (masks[q] != 0)
+        touching[q] |= differ & (masks[p] != 0)
+    return thick & ((masks == 0) | touching)
+
+
+@contextmanager
+def _result_file(field, name):
+    """Yield a temporary file on disk that is saved to ``field`` on exit
+    
+    Results are written to disk and streamed to storage in chunks, so
+    peak memory does not grow with the size of the output.
+    """
+    with tempfile.TemporaryFile() as fh:
+        yield fh
+        fh.seek(0)
+        field.save(name, File(fh), save=False)
+
 
 class CellposeService:
     """Service class for handling Cellpose predictions"""
     
     def __init__(self):
+        # Loaded on first predict(), not at import or fork time
         self.model = None
-        self._load_model()
+        self._model_lock = threading.Lock()
     
     def _load_model(self):
         """Load the Cellpose model"""
         try:
             # Use GPU if available
             gpu = settings.CELLPOSE_DEVICE == 'cuda'
+            # bfloat16 weights halve memory traffic of the network on GPU
+            use_bfloat16 = getattr(settings, 'CELLPOSE_USE_BFLOAT16', True)
             self.model = models.CellposeModel(
                 gpu=gpu,
-                pretrained_model=settings.CELLPOSE_MODEL_PATH
+                pretrained_model=settings.CELLPOSE_MODEL_PATH,
+                use_bfloat16=use_bfloat16
             )
-            logger.info(f"Cellpose model loaded successfully on {settings.CELLPOSE_DEVICE}")
+            precision = 'bfloat16' if use_bfloat16 else 'float32'
+            logger.info(f"Cellpose model loaded successfully on {settings.CELLPOSE_DEVICE} ({precision})")
         except Exception as e:
             logger.error(f"Failed to load Cellpose model: {str(e)}")
             raise
     
+    def _get_model(self):
+        """Return the loaded model, loading it once on first use"""
+        if self.model is None:
+            with self._model_lock:
+                if self.model is None:
+                    self._load_model()
+        return self.model
+    
     def predict(self, job_id):
         """Run Cellpose prediction on a job"""
         try:
+            model = self._get_model()
+            
             job = PredictionJob.objects.get(id=job_id)
             job.status = 'processing'
             job.save()
@@ -57,7 +207,7 @@ class CellposeService:
             img = io.imread(image_path)
             
             # Run prediction
-            masks, flows, styles = self.model.eval(
+            masks, flows, styles = model.eval(
                 img,
                 diameter=job.diameter,
                 flow_threshold=job.flow_threshold,
@@ -68,158 +218,175 @@ class CellposeService:
             
             processing_time = time.time() - start_time
             
+            # Per-cell geometry, computed once for all stages below
+            cell_ids = _cell_ids(masks)
+            slices = ndimage.find_objects(masks)
+            table = measure.regionprops_table(masks, properties=CELL_METRIC_PROPERTIES)
+            
             # Save results
-            self._save_results(job, img, masks, flows, styles)
+            self._save_results(job, img, masks, flows, styles, cell_ids)
             
             # Calculate metrics
-            self._calculate_metrics(job, img, masks)
+            self._calculate_metrics(job, table)
             
             # Create individual segmented images and TIF files
-            self._create_individual_segments(job, img, masks)
+            self._create_individual_segments(job, img, masks, slices)
             
             # Send to Modal if configured
             if hasattr(settings, 'MODAL_ENDPOINT_URL') and settings.MODAL_ENDPOINT_URL:
-                self._send_to_modal(job, masks, flows)
+                self._send_to_modal(job, masks, len(cell_ids))
             
             # Update job status
             job.status = 'completed'
-            job.num_cells_detected = len(np.unique(masks)) - 1  # Exclude background
+            job.num_cells_detected = len(cell_ids)
             job.processing_time = processing_time
             job.save()
             
             logger.info(f"Prediction job {job_id} completed successfully")
             
+            if job.callback_url:
+                self._notify_callback(job)
+            
         except Exception as e:
             logger.error(f"Prediction job {job_id} failed: {str(e)}")
             job = PredictionJob.objects.get(id=job_id)
             job.status = 'failed'
             job.error_message = str(e)
             job.save()
+            if job.callback_url:
+                self._notify_callback(job)
             raise
     
-    def _save_results(self, job, img, masks, flows, styles):
+    def _save_results(self, job, img, masks, flows, styles, cell_ids):
         """Save prediction results to files"""
         
-        # Save masks as numpy array
-        masks_buffer = BytesIO()
-        np.save(masks_buffer, masks)
-        masks_buffer.seek(0)
-        job.result_masks.save(
-            f'masks_{job.id}.npy',
-            ContentFile(masks_buffer.getvalue()),
-            save=False
-        )
+        # Save masks as compressed uint16 labels (uint32 above 65535 cells)
+        masks_dtype = np.uint16 if masks.max() < 2**16 else np.uint32
+        with _result_file(job.result_masks, f'masks_{job.id}.npz') as fh:
+            np.savez_compressed(fh, masks=masks.astype(masks_dtype, copy=False))
         
-        # Save flows
-        flows_buffer = BytesIO()
-        np.save(flows_buffer, flows)
-        flows_buffer.seek(0)
-        job.result_flows.save(
-            f'flows_{job.id}.npy',
-            ContentFile(flows_buffer.getvalue()),
-            save=False
-        )
+        # Save flows, flows[k] is stored as arr_k (arrays differ in shape)
+        with _result_file(job.result_flows, f'flows_{job.id}.npz') as fh:
+            np.savez(fh, *flows)
         
         # Create segmented image overlay
-        segmented_img = self._create_segmented_overlay(img, masks)
-        segmented_buffer = BytesIO()
-        cv2.imwrite(segmented_buffer, segmented_img)
-        segmented_buffer.seek(0)
+        segmented_img = self._create_segmented_overlay(img, masks, cell_ids)
+        ok, segmented_png = cv2.imencode('.png', segmented_img)
+        if not ok:
+            raise ValueError("Failed to encode segmented image as PNG")
         job.result_segmented_images.save(
             f'segmented_{job.id}.png',
-            ContentFile(segmented_buffer.getvalue()),
+            ContentFile(segmented_png.tobytes()),
             save=False
         )
         
         job.save()
     
-    def _create_segmented_overlay(self, img, masks):
-        """Create a visual overlay of segmentation on original image"""
-        if len(img.shape) == 2:
-            # Convert grayscale to RGB
-            img_rgb = cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
-        else:
-            img_rgb = img.copy()
+    def _create_segmented_overlay(self, img, masks, cell_ids, tile_rows=None):
+        """Create a visual overlay of segmentation on original image
         
-        # Create colored overlay
-        overlay = np.zeros_like(img_rgb)
+        The overlay is rendered in stripes of ``tile_rows`` rows, so
+        temporary arrays scale with the stripe rather than the image.
+        """
+        Ly, Lx = masks.shape
+        tile_rows = tile_rows or OVERLAY_TILE_ROWS
         
         # Generate random colors for each mask
-        unique_masks = np.unique(masks)[1:]  # Exclude background
-        colors = np.random.randint(0, 255, (len(unique_masks), 3))
+        colors = np.random.randint(0, 255, (len(cell_ids), 3))
         
-        for i, mask_id in enumerate(unique_masks):
-            mask_pixels = masks == mask_id
-            overlay[mask_pixels] = colors[i]
+        # Label -> color lookup table, gathered per stripe
+        lut = np.zeros((int(masks.max()) + 1, 3), dtype=img.dtype)
+        lut[cell_ids] = colors
         
-        # Blend original image with overlay
-        result = cv2.addWeighted(img_rgb, 0.7, overlay, 0.3, 0)
-        
-        # Add boundaries
-        boundaries = find_boundaries(masks, mode='outer')
-        result[boundaries] = [255, 255, 255]  # White boundaries
+        result = np.empty((Ly, Lx, 3) if img.ndim == 2 else img.shape, dtype=img.dtype)
+        for y0 in range(0, Ly, tile_rows):
+            y1 = min(y0 + tile_rows, Ly)
+            img_tile = img[y0:y1]
+            if img_tile.ndim == 2:
+                # Convert grayscale to RGB
+                img_tile = cv2.cvtColor(img_tile, cv2.COLOR_GRAY2RGB)
+            
+            # Blend original image with overlay
+            result[y0:y1] = cv2.addWeighted(img_tile, 0.7, lut[masks[y0:y1]], 0.3, 0)
+            
+            # Add boundaries, with a 1 row halo so stripe edges see their neighbors
+            h0, h1 = max(y0 - 1, 0), min(y1 + 1, Ly)
+            boundaries = _outer_boundaries(masks[h0:h1])[y0 - h0:y1 - h0]
+            result[y0:y1][boundaries] = [255, 255, 255]  # White boundaries
         
         return result
     
-    def _calculate_metrics(self, job, img, masks):
-        """Calculate metrics for each detected cell"""
+    def _calculate_metrics(self, job, table):
+        """Store metrics for each detected cell from a regionprops_table
+        computed with CELL_METRIC_PROPERTIES"""
+        
+        # CellMetrics field -> column of values
+        columns = {
+            'cell_id': table['label'],
+            'area': table['area'],
+            'perimeter': table['perimeter'],
+            'centroid_x': table['centroid-1'],
+            'centroid_y': table['centroid-0'],
+            'aspect_ratio': _aspect_ratio(table),
+            'eccentricity': table['eccentricity'],
+            'solidity': table['solidity'],
+            'extent': table['extent'],
+            'bbox_min_row': table['bbox-0'],
+            'bbox_min_col': table['bbox-1'],
+            'bbox_max_row': table['bbox-2'],
+            'bbox_max_col': table['bbox-3'],
+            'equivalent_diameter': table['equivalent_diameter_area'],
+        }
         
-        # Get region properties
-        props = measure.regionprops(masks)
+        # Build plain tuples instead of CellMetrics instances
+        job_pk = PredictionJob._meta.pk.get_db_prep_value(job.pk, connection)
+        values = zip(*(column.tolist() for column in columns.values()))
+        rows = [(job_pk, *row) for row in values]
         
-        # Clear existing metrics
-        CellMetrics.objects.filter(prediction_job=job).delete()
+        opts = CellMetrics._meta
+        fields = [opts.get_field('prediction_job')] + [opts.get_field(name) for name in columns]
+        qn = connection.ops.quote_name
+        placeholder = '(' + ', '.join(['%s'] * len(fields)) + ')'
         
-        # Calculate metrics for each cell
-        metrics_list = []
-        for prop in props:
-            metrics = CellMetrics(
-                prediction_job=job,
-                cell_id=prop.label,
-                area=prop.area,
-                perimeter=prop.perimeter,
-                centroid_x=prop.centroid[1],
-                centroid_y=prop.centroid[0],
-                aspect_ratio=prop.major_axis_length / prop.minor_axis_length if prop.minor_axis_length > 0 else 0,
-                eccentricity=prop.eccentricity,
-                solidity=prop.solidity,
-                extent=prop.extent,
-                bbox_min_row=prop.bbox[0],
-                bbox_min_col=prop.bbox[1],
-                bbox_max_row=prop.bbox[2],
-                bbox_max_col=prop.bbox[3],
-                equivalent_diameter=prop.equivalent_diameter
-            )
-            metrics_list.append(metrics)
+        # Rows per INSERT, capped by the backend's query parameter limit
+        batch_size = getattr(settings, 'CELLMETRICS_BULK_BATCH_SIZE', 500)
+        batch_size = max(1, min(batch_size, connection.ops.bulk_batch_size(fields, rows)))
         
-        # Bulk create metrics
-        CellMetrics.objects.bulk_create(metrics_list)
+        with transaction.atomic():
+            # Clear existing metrics
+            CellMetrics.objects.filter(prediction_job=job).delete()
+            
+            with connection.cursor() as cursor:
+                for i in range(0, len(rows), batch_size):
+                    batch = rows[i:i + batch_size]
+                    sql = 'INSERT INTO {} ({}) VALUES {}'.format(
+                        qn(opts.db_table),
+                        ', '.join(qn(field.column) for field in fields),
+                        ', '.join([placeholder] * len(batch))
+                    )
+                    cursor.execute(sql, [value for row in batch for value in row])
     
-    def _create_individual_segments(self, job, img, masks):
-        """Create individual segmented images and TIF files"""
+    def _create_individual_segments(self, job, img, masks, slices):
+        """Create individual segmented images and TIF files
+        
+        ``slices`` is ndimage.find_objects(masks), the bounding box of
+        label i + 1 at index i.
+        """
         
         # Create a zip file containing individual cell images
-        zip_buffer = BytesIO()
+        archive_name = f'individual_cells_{job.id}.zip'
         
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            unique_masks = np.unique(masks)[1:]  # Exclude background
-            
-            for mask_id in unique_masks:
-                # Create binary mask for this cell
-                cell_mask = (masks == mask_id).astype(np.uint8)
-                
-                # Get bounding box
-                props = measure.regionprops(cell_mask)[0]
-                bbox = props.bbox
+        with _result_file(job.result_tif_archive, archive_name) as fh, \
+                zipfile.ZipFile(fh, 'w', zipfile.ZIP_STORED) as zip_file:
+            for mask_id, bbox in enumerate(slices, start=1):
+                if bbox is None:
+                    continue  # label not present in masks
                 
                 # Extract cell region from original image
-                if len(img.shape) == 2:
-                    cell_img = img[bbox[0]:bbox[2], bbox[1]:bbox[3]]
-                else:
-                    cell_img = img[bbox[0]:bbox[2], bbox[1]:bbox[3], :]
+                cell_img = img[bbox]
                 
-                # Extract mask region
-                cell_mask_cropped = cell_mask[bbox[0]:bbox[2], bbox[1]:bbox[3]]
+                # Binary mask of this cell within its bounding box
+                cell_mask_cropped = (masks[bbox] == mask_id).astype(np.uint8)
                 
                 # Apply mask to image
                 if len(img.shape) == 2:
@@ -227,9 +394,11 @@ class CellposeService:
                 else:
                     masked_cell = cell_img * cell_mask_cropped[:, :, np.newaxis]
                 
-                # Save as TIF
+                # Save as TIF, compressed by tifffile since the archive is
+                # stored uncompressed (PNG entries are already deflated)
                 tif_buffer = BytesIO()
-                tifffile.imwrite(tif_buffer, masked_cell.astype(np.uint16))
+                tifffile.imwrite(tif_buffer, masked_cell.astype(np.uint16),
+                                 compression='zlib', compressionargs={'level': 1})
                 zip_file.writestr(f'cell_{mask_id:04d}.tif', tif_buffer.getvalue())
                 
                 # Also save as PNG for visualization
@@ -238,31 +407,24 @@ class CellposeService:
                 else:
                     png_img = masked_cell.astype(np.uint8)
                 
-                png_buffer = BytesIO()
-                cv2.imencode('.png', png_img)[1].tobytes()
-                zip_file.writestr(f'cell_{mask_id:04d}.png', png_buffer.getvalue())
+                _, png_data = cv2.imencode('.png', png_img)
+                zip_file.writestr(f'cell_{mask_id:04d}.png', png_data.tobytes())
         
-        zip_buffer.seek(0)
-        job.result_tif_archive.save(
-            f'individual_cells_{job.id}.zip',
-            ContentFile(zip_buffer.getvalue()),
-            save=False
-        )
         job.save()
     
-    def _send_to_modal(self, job, masks, flows):
+    def _send_to_modal(self, job, masks, num_cells):
         """Send results to Modal endpoint"""
         try:
             # Prepare data for Modal
             data = {
                 'job_id': str(job.id),
-                'num_cells': len(np.unique(masks)) - 1,
+                'num_cells': num_cells,
                 'masks_shape': masks.shape,
                 'processing_time': job.processing_time
             }
             
             # Send POST request to Modal
-            response = requests.post(
+            response = _modal_session.post(
                 settings.MODAL_ENDPOINT_URL,
                 json=data,
                 timeout=30
@@ -274,6 +436,31 @@ class CellposeService:
         except Exception as e:
             logger.error(f"Failed to send job {job.id} to Modal: {str(e)}")
             # Don't fail the entire job if Modal fails
+    
+    def _notify_callback(self, job):
+        """POST the final job status to the callback_url given at submission"""
+        try:
+            # Same fields as the Modal payload, so receive_cellpose_results
+            # in modal_integration.py can be used as a callback_url
+            data = {
+                'job_id': str(job.id),
+                'status': job.status,
+                'num_cells': job.num_cells_detected,
+                'processing_time': job.processing_time,
+                'error_message': job.error_message
+            }
+            
+            # Checked again at send time, DNS may have changed since submission
+            check_callback_url(job.callback_url)
+            response = _callback_session.post(
+                job.callback_url, json=data, timeout=10, allow_redirects=False
+            )
+            response.raise_for_status()
+            
+            logger.info(f"Notified callback for job {job.id}")
+            
+        except Exception as e:
+            logger.error(f"Failed to notify callback for job {job.id}: {str(e)}")
 
 
 class MetricsService:
@@ -299,27 +486,26 @@ class MetricsService:
     @staticmethod
     def get_cell_shape_analysis(masks):
         """Get detailed shape analysis for all cells"""
-        props = measure.regionprops(masks)
+        table = measure.regionprops_table(masks, properties=SHAPE_ANALYSIS_PROPERTIES)
         
-        analysis = []
-        for prop in props:
-            cell_analysis = {
-                'cell_id': prop.label,
-                'area': prop.area,
-                'perimeter': prop.perimeter,
-                'aspect_ratio': prop.major_axis_length / prop.minor_axis_length if prop.minor_axis_length > 0 else 0,
-                'eccentricity': prop.eccentricity,
-                'solidity': prop.solidity,
-                'extent': prop.extent,
-                'equivalent_diameter': prop.equivalent_diameter,
-                'orientation': prop.orientation,
-                'major_axis_length': prop.major_axis_length,
-                'minor_axis_length': prop.minor_axis_length,
-                'convex_area': prop.convex_area,
-                'filled_area': prop.filled_area,
-                'euler_number': prop.euler_number
-            }
-            analysis.append(cell_analysis)
+        # Output key -> regionprops_table column
+        columns = {
+            'cell_id': table['label'],
+            'area': table['area'],
+            'perimeter': table['perimeter'],
+            'aspect_ratio': _aspect_ratio(table),
+            'eccentricity': table['eccentricity'],
+            'solidity': table['solidity'],
+            'extent': table['extent'],
+            'equivalent_diameter': table['equivalent_diameter_area'],
+            'orientation': table['orientation'],
+            'major_axis_length': table['axis_major_length'],
+            'minor_axis_length': table['axis_minor_length'],
+            'convex_area': table['area_convex'],
+            'filled_area': table['area_filled'],
+            'euler_number': table['euler_number']
+        }
         
-        return analysis
-
+        keys = list(columns)
+        values = zip(*(column.tolist() for column in columns.values()))
+        return [dict(zip(keys, row)) for row in values]
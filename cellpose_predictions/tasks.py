@@ -0,0 +1,13 @@
+from celery import shared_task
+import logging
+
+from .services import get_cellpose_service
+
+logger = logging.getLogger(__name__)
+
+
+@shared_task(bind=True, name='cellpose_predictions.run_prediction')
+def run_prediction(self, job_id):
+    """Run Cellpose prediction for a job on the worker's loaded model"""
+    logger.info(f"Worker {self.request.hostname} picked up prediction job {job_id}")
+    get_cellpose_service().predict(job_id)
@@ -2,23 +2,63 @@ from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.parsers import MultiPartParser, FormParser
-from django.shortcuts import get_object_or_404
-from django.http import HttpResponse, Http404
-from django.core.files.storage import default_storage
-import threading
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.generics import get_object_or_404
+from django.conf import settings
+from django.http import FileResponse, Http404
+from django.urls import reverse
+from django.db.models import Avg, Count, Max, Min, Q
+from kombu.exceptions import OperationalError
 import logging
+import os
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit
 
 from .models import PredictionJob, CellMetrics
 from .serializers import (
     PredictionJobSerializer, 
     PredictionJobCreateSerializer,
     PredictionJobStatusSerializer,
+    PredictionJobBundleSerializer,
     CellMetricsSerializer
 )
-from .services import CellposeService, MetricsService
+from .services import MetricsService, load_masks
+from .tasks import run_prediction
 
 logger = logging.getLogger(__name__)
 
+# Longest time a /wait/ request is held open, and how often it re-reads the job
+LONG_POLL_MAX_TIMEOUT = 30
+LONG_POLL_INTERVAL = 2
+
+# Requests a server process holds open in /wait/ at once, so waiters can not
+# take every worker thread away from the other endpoints
+_long_poll_slots = threading.BoundedSemaphore(settings.CELLPOSE_LONG_POLL_MAX_WAITERS)
+
+
+class CellMetricsPagination(PageNumberPagination):
+    """Pagination for per-cell metrics of a single job"""
+    
+    page_size = 500
+    page_size_query_param = 'page_size'
+    max_page_size = 5000
+    
+    def __init__(self, link_path=None):
+        # Path for next/previous links, defaults to the current request's
+        self.link_path = link_path
+    
+    def _relink(self, url):
+        if url is None or self.link_path is None:
+            return url
+        return urlunsplit(urlsplit(url)._replace(path=self.link_path))
+    
+    def get_next_link(self):
+        return self._relink(super().get_next_link())
+    
+    def get_previous_link(self):
+        return self._relink(super().get_previous_link())
+
 
 class PredictionJobViewSet(viewsets.ModelViewSet):
     """ViewSet for managing Cellpose prediction jobs"""
@@ -26,10 +66,17 @@ class PredictionJobViewSet(viewsets.ModelViewSet):
     queryset = PredictionJob.objects.all()
     parser_classes = [MultiPartParser, FormParser]
     
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        # PredictionJobSerializer nests cell_metrics; fetch them in one query
+        if self.action in ('list', 'retrieve', 'results'):
+            queryset = queryset.prefetch_related('cell_metrics')
+        return queryset
+    
     def get_serializer_class(self):
         if self.action == 'create':
             return PredictionJobCreateSerializer
-        elif self.action == 'status':
+        elif self.action in ('status', 'wait'):
             return PredictionJobStatusSerializer
         return PredictionJobSerializer
     
@@ -41,21 +88,27 @@ class PredictionJobViewSet(viewsets.ModelViewSet):
         # Create job
         job = serializer.save(user=request.user if request.user.is_authenticated else None)
         
-        # Start prediction in background thread
-        def run_prediction():
-            try:
-                service = CellposeService()
-                service.predict(job.id)
-            except Exception as e:
-                logger.error(f"Background prediction failed for job {job.id}: {str(e)}")
-        
-        thread = threading.Thread(target=run_prediction)
-        thread.daemon = True
-        thread.start()
+        # Queue prediction on a Celery worker holding a loaded model
+        try:
+            run_prediction.delay(str(job.id))
+        except OperationalError as e:
+            # Broker unreachable: fail the job so nobody waits on it forever
+            logger.error(f"Could not queue prediction job {job.id}: {str(e)}")
+            job.status = 'failed'
+            job.error_message = f"Could not queue prediction: {str(e)}"
+            job.save(update_fields=['status', 'error_message', 'updated_at'])
+            return Response(
+                {'id': str(job.id), 'status': job.status,
+                 'error': 'Prediction queue is unavailable, please retry later'},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE
+            )
         
-        # Return job details
-        response_serializer = PredictionJobSerializer(job)
-        return Response(response_serializer.data, status=status.HTTP_201_CREATED)
+        # Accepted for processing; clients poll the status endpoint
+        return Response(
+            {'id': str(job.id), 'status': job.status},
+            status=status.HTTP_202_ACCEPTED,
+            headers={'Location': reverse('predictions-status', kwargs={'pk': job.pk})}
+        )
     
     @action(detail=True, methods=['get'])
     def status(self, request, pk=None):
@@ -64,6 +117,54 @@ class PredictionJobViewSet(viewsets.ModelViewSet):
         serializer = PredictionJobStatusSerializer(job)
         return Response(serializer.data)
     
+    @action(detail=True, methods=['get'])
+    def wait(self, request, pk=None):
+        """Long-poll the job status
+        
+        Holds the request until the status differs from ``?status=`` (the
+        current status by default), the job has finished, or ``?timeout=``
+        seconds have passed, then answers like the status endpoint. Answers
+        429 with Retry-After when all long-poll slots are taken.
+        """
+        job = self.get_object()
+        last_seen = request.query_params.get('status', job.status)
+        try:
+            timeout = float(request.query_params.get('timeout', LONG_POLL_MAX_TIMEOUT))
+        except ValueError:
+            timeout = None
+        if timeout is None or not timeout >= 0:  # also rejects nan
+            return Response(
+                {'error': 'timeout must be a non-negative number of seconds'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        deadline = time.monotonic() + min(timeout, LONG_POLL_MAX_TIMEOUT)
+        
+        if job.status == last_seen and job.status not in ('completed', 'failed') and timeout > 0:
+            if not _long_poll_slots.acquire(blocking=False):
+                return Response(
+                    {'error': 'Too many waiting requests, poll the status endpoint instead'},
+                    status=status.HTTP_429_TOO_MANY_REQUESTS,
+                    headers={'Retry-After': str(LONG_POLL_INTERVAL)}
+                )
+            try:
+                current = job.status
+                while current == last_seen:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    time.sleep(min(LONG_POLL_INTERVAL, remaining))
+                    # Primary key lookup of a single column
+                    current = PredictionJob.objects.filter(pk=job.pk).values_list('status', flat=True).first()
+            finally:
+                _long_poll_slots.release()
+            if current is None:
+                raise Http404("Job was deleted")
+            if current != job.status:
+                job.refresh_from_db(fields=['status', 'updated_at', 'num_cells_detected', 'processing_time'])
+        
+        serializer = PredictionJobStatusSerializer(job)
+        return Response(serializer.data)
+    
     @action(detail=True, methods=['get'])
     def results(self, request, pk=None):
         """Get detailed job results including metrics"""
@@ -78,73 +179,49 @@ class PredictionJobViewSet(viewsets.ModelViewSet):
         serializer = PredictionJobSerializer(job)
         return Response(serializer.data)
     
-    @action(detail=True, methods=['get'])
-    def download_masks(self, request, pk=None):
-        """Download masks file"""
-        job = self.get_object()
+    def _download(self, pk, field_name, basename, content_type, not_found):
+        """Stream a result file, loading only the job columns it needs"""
+        job = get_object_or_404(self.get_queryset().only('id', field_name), pk=pk)
+        self.check_object_permissions(self.request, job)
         
-        if not job.result_masks:
-            raise Http404("Masks file not found")
+        result_file = getattr(job, field_name)
+        if not result_file:
+            raise Http404(not_found)
         
+        ext = os.path.splitext(result_file.name)[1]  # masks/flows: .npy for older jobs
         try:
-            file_path = job.result_masks.path
-            with open(file_path, 'rb') as f:
-                response = HttpResponse(f.read(), content_type='application/octet-stream')
-                response['Content-Disposition'] = f'attachment; filename="masks_{job.id}.npy"'
-                return response
+            return FileResponse(
+                result_file.open('rb'),
+                as_attachment=True,
+                filename=f'{basename}_{job.id}{ext}',
+                content_type=content_type
+            )
         except FileNotFoundError:
-            raise Http404("Masks file not found")
+            raise Http404(not_found)
+    
+    @action(detail=True, methods=['get'])
+    def download_masks(self, request, pk=None):
+        """Download masks file"""
+        return self._download(pk, 'result_masks', 'masks',
+                              'application/octet-stream', "Masks file not found")
     
     @action(detail=True, methods=['get'])
     def download_flows(self, request, pk=None):
         """Download flows file"""
-        job = self.get_object()
-        
-        if not job.result_flows:
-            raise Http404("Flows file not found")
-        
-        try:
-            file_path = job.result_flows.path
-            with open(file_path, 'rb') as f:
-                response = HttpResponse(f.read(), content_type='application/octet-stream')
-                response['Content-Disposition'] = f'attachment; filename="flows_{job.id}.npy"'
-                return response
-        except FileNotFoundError:
-            raise Http404("Flows file not found")
+        return self._download(pk, 'result_flows', 'flows',
+                              'application/octet-stream', "Flows file not found")
     
     @action(detail=True, methods=['get'])
     def download_segmented_image(self, request, pk=None):
         """Download segmented image"""
-        job = self.get_object()
-        
-        if not job.result_segmented_images:
-            raise Http404("Segmented image not found")
-        
-        try:
-            file_path = job.result_segmented_images.path
-            with open(file_path, 'rb') as f:
-                response = HttpResponse(f.read(), content_type='image/png')
-                response['Content-Disposition'] = f'attachment; filename="segmented_{job.id}.png"'
-                return response
-        except FileNotFoundError:
-            raise Http404("Segmented image not found")
+        return self._download(pk, 'result_segmented_images', 'segmented',
+                              'image/png', "Segmented image not found")
     
     @action(detail=True, methods=['get'])
     def download_individual_cells(self, request, pk=None):
         """Download individual cell TIF files as ZIP"""
-        job = self.get_object()
-        
-        if not job.result_tif_archive:
-            raise Http404("Individual cells archive not found")
-        
-        try:
-            file_path = job.result_tif_archive.path
-            with open(file_path, 'rb') as f:
-                response = HttpResponse(f.read(), content_type='application/zip')
-                response['Content-Disposition'] = f'attachment; filename="individual_cells_{job.id}.zip"'
-                return response
-        except FileNotFoundError:
-            raise Http404("Individual cells archive not found")
+        return self._download(pk, 'result_tif_archive', 'individual_cells',
+                              'application/zip', "Individual cells archive not found")
     
     @action(detail=True, methods=['get'])
     def metrics(self, request, pk=None):
@@ -157,39 +234,69 @@ class PredictionJobViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
+        return Response(self._metrics_payload(request, job))
+    
+    @action(detail=True, methods=['get'])
+    def bundle(self, request, pk=None):
+        """Get status, results and metrics of a job in one response"""
+        job = self.get_object()
+        data = {
+            'status': PredictionJobStatusSerializer(job).data,
+            'results': None,
+            'metrics': None,
+        }
+        if job.status == 'completed':
+            data['results'] = PredictionJobBundleSerializer(job).data
+            data['metrics'] = self._metrics_payload(request, job)
+        return Response(data)
+    
+    def _metrics_payload(self, request, job):
+        """Summary and one page of per-cell metrics for a completed job"""
         metrics = CellMetrics.objects.filter(prediction_job=job)
-        serializer = CellMetricsSerializer(metrics, many=True)
         
-        # Calculate summary statistics
-        if metrics.exists():
-            areas = [m.area for m in metrics]
-            aspect_ratios = [m.aspect_ratio for m in metrics]
-            
-            summary = {
-                'total_cells': len(metrics),
-                'average_area': sum(areas) / len(areas),
-                'min_area': min(areas),
-                'max_area': max(areas),
-                'average_aspect_ratio': sum(aspect_ratios) / len(aspect_ratios),
-                'min_aspect_ratio': min(aspect_ratios),
-                'max_aspect_ratio': max(aspect_ratios),
-            }
-        else:
+        # Calculate summary statistics in the database
+        summary = metrics.aggregate(
+            total_cells=Count('id'),
+            average_area=Avg('area'),
+            min_area=Min('area'),
+            max_area=Max('area'),
+            average_aspect_ratio=Avg('aspect_ratio'),
+            min_aspect_ratio=Min('aspect_ratio'),
+            max_aspect_ratio=Max('aspect_ratio'),
+        )
+        if not summary['total_cells']:
             summary = {'total_cells': 0}
         
-        return Response({
+        # Serialize one page of individual cells; further pages always come
+        # from the metrics endpoint, also when called from bundle
+        paginator = CellMetricsPagination(
+            link_path=reverse('predictions-metrics', kwargs={'pk': job.pk})
+        )
+        page = paginator.paginate_queryset(metrics, request, view=self)
+        serializer = CellMetricsSerializer(page, many=True)
+        
+        return {
             'summary': summary,
+            'next': paginator.get_next_link(),
+            'previous': paginator.get_previous_link(),
             'individual_metrics': serializer.data
-        })
+        }
     
     @action(detail=False, methods=['get'])
     def stats(self, request):
         """Get overall statistics"""
-        total_jobs = PredictionJob.objects.count()
-        completed_jobs = PredictionJob.objects.filter(status='completed').count()
-        failed_jobs = PredictionJob.objects.filter(status='failed').count()
-        pending_jobs = PredictionJob.objects.filter(status='pending').count()
-        processing_jobs = PredictionJob.objects.filter(status='processing').count()
+        counts = PredictionJob.objects.aggregate(
+            total_jobs=Count('id'),
+            completed_jobs=Count('id', filter=Q(status='completed')),
+            failed_jobs=Count('id', filter=Q(status='failed')),
+            pending_jobs=Count('id', filter=Q(status='pending')),
+            processing_jobs=Count('id', filter=Q(status='processing')),
+        )
+        total_jobs = counts['total_jobs']
+        completed_jobs = counts['completed_jobs']
+        failed_jobs = counts['failed_jobs']
+        pending_jobs = counts['pending_jobs']
+        processing_jobs = counts['processing_jobs']
         
         return Response({
             'total_jobs': total_jobs,
@@ -233,8 +340,7 @@ class CellMetricsViewSet(viewsets.ReadOnlyModelViewSet):
                 )
             
             # Load masks and perform shape analysis
-            import numpy as np
-            masks = np.load(job.result_masks.path)
+            masks = load_masks(job.result_masks.path)
             analysis = MetricsService.get_cell_shape_analysis(masks)
             
             return Response({'shape_analysis': analysis})
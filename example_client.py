@@ -4,62 +4,203 @@ Example client for Cellpose Django REST API
 Demonstrates how to use the API to submit images and retrieve results
 """
 
+import asyncio
+import aiohttp
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
 import json
 import os
+import random
 from pathlib import Path
 
+try:
+    from requests_toolbelt.multipart.encoder import MultipartEncoder
+except ImportError:  # requests-toolbelt is optional, uploads are buffered without it
+    MultipartEncoder = None
 
-class CellposeAPIClient:
+try:
+    from orjson import loads as json_loads
+except ImportError:  # orjson is optional, json.loads accepts bytes as well
+    json_loads = json.loads
+
+TERMINAL_STATUSES = ('completed', 'failed')
+DOWNLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB
+STATUS_PRINT_INTERVAL = 30  # seconds between repeated status lines while waiting
+BATCH_CONCURRENCY = 16  # jobs batch_example keeps in flight at once
+
+# file_type -> local filename prefix and extension used by download_all
+DOWNLOAD_FILENAMES = {
+    'segmented_image': ('segmented', '.png'),
+    'individual_cells': ('individual_cells', '.zip'),
+    'masks': ('masks', '.npz'),
+    'flows': ('flows', '.npz'),
+}
+
+
+class _ResponseCache:
+    """Per-client cache of JSON responses keyed by ``(endpoint, job_id)``
+    
+    Entries are stamped with ``time.monotonic()`` (in ms) once the response
+    has arrived. Entries for data that can no longer change are stored
+    without a timestamp and never expire.
+    """
+    
+    def _cache_lookup(self, key, ttl_ms):
+        """Return the cached value for key, or None if missing or stale"""
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        fetched_at, value = entry
+        if fetched_at is None or time.monotonic() * 1000 - fetched_at < ttl_ms:
+            return value
+        return None
+    
+    def _cache_store(self, key, value, permanent=False):
+        fetched_at = None if permanent else time.monotonic() * 1000
+        self._cache[key] = (fetched_at, value)
+        return value
+
+
+class _EndpointURLs:
+    """URL templates for the prediction endpoints, built once per client
+    
+    Templates are filled in with ``%`` so a request does not re-format the
+    base URL each time.
+    """
+    
+    def _build_urls(self, base_url):
+        predictions = f"{base_url}/predictions/"
+        self._url_submit = predictions
+        self._url_status = predictions + "%s/status/"
+        self._url_results = predictions + "%s/results/"
+        self._url_metrics = predictions + "%s/metrics/"
+        self._url_bundle = predictions + "%s/bundle/"
+        self._url_wait = predictions + "%s/wait/"
+        self._url_download = predictions + "%s/download_%s/"
+
+
+class CellposeAPIClient(_EndpointURLs, _ResponseCache):
     """Client for interacting with Cellpose Django REST API"""
     
     def __init__(self, base_url="http://localhost:8000/api/v1"):
         self.base_url = base_url
+        self._build_urls(base_url)
         self.session = requests.Session()
+        # Keep enough pooled connections alive for batch submissions and
+        # retry idempotent requests when a proxy in front of Django hiccups
+        adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Connection': 'keep-alive'})
+        self._cache = {}
+        
+        # Open the pooled connection now so submit_image does not pay for
+        # the DNS lookup and handshakes. The adapter has no retries yet, so
+        # a down server costs one 2 s attempt at most.
+        try:
+            self.session.head(f"{self.base_url}/", timeout=2, allow_redirects=True)
+        except requests.RequestException:
+            pass  # warm-up is best-effort
+        adapter.max_retries = Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
     
-    def submit_image(self, image_path, **kwargs):
+    def submit_image(self, image_path, callback_url=None, **kwargs):
         """
         Submit an image for Cellpose prediction
         
         Args:
             image_path: Path to image file
+            callback_url: Optional URL the server POSTs to when the job finishes
             **kwargs: Additional parameters (diameter, flow_threshold, etc.)
         
         Returns:
             dict: Job information including job ID
         """
-        url = f"{self.base_url}/predictions/"
+        url = self._url_submit
+        if callback_url:
+            kwargs['callback_url'] = callback_url
         
         with open(image_path, 'rb') as f:
-            files = {'input_image': f}
-            data = kwargs
-            
-            response = self.session.post(url, files=files, data=data)
+            if MultipartEncoder is not None:
+                # Stream the multipart body from disk instead of building it in memory
+                encoder = MultipartEncoder(fields={
+                    'input_image': (os.path.basename(image_path), f, 'application/octet-stream'),
+                    **{key: str(value) for key, value in kwargs.items()}
+                })
+                response = self.session.post(
+                    url, data=encoder, headers={'Content-Type': encoder.content_type}
+                )
+            else:
+                response = self.session.post(url, files={'input_image': f}, data=kwargs)
             response.raise_for_status()
             
-            return response.json()
+            return json_loads(response.content)
     
-    def get_job_status(self, job_id):
-        """Get current status of a prediction job"""
-        url = f"{self.base_url}/predictions/{job_id}/status/"
+    def get_job_status(self, job_id, ttl_ms=0):
+        """
+        Get current status of a prediction job
+        
+        A status fetched less than ``ttl_ms`` milliseconds ago is returned
+        from the client cache. Completed and failed statuses are final and
+        are always served from the cache once seen.
+        """
+        key = ('status', job_id)
+        cached = self._cache_lookup(key, ttl_ms)
+        if cached is not None:
+            return cached
+        
+        url = self._url_status % job_id
         response = self.session.get(url)
         response.raise_for_status()
-        return response.json()
+        status = json_loads(response.content)
+        return self._cache_store(key, status, permanent=status['status'] in TERMINAL_STATUSES)
     
     def get_results(self, job_id):
         """Get complete results for a completed job"""
-        url = f"{self.base_url}/predictions/{job_id}/results/"
+        key = ('results', job_id)
+        cached = self._cache_lookup(key, 0)
+        if cached is not None:
+            return cached
+        
+        url = self._url_results % job_id
         response = self.session.get(url)
         response.raise_for_status()
-        return response.json()
+        # Only completed jobs have results, so they never change
+        return self._cache_store(key, json_loads(response.content), permanent=True)
     
     def get_metrics(self, job_id):
         """Get detailed metrics for all detected cells"""
-        url = f"{self.base_url}/predictions/{job_id}/metrics/"
+        key = ('metrics', job_id)
+        cached = self._cache_lookup(key, 0)
+        if cached is not None:
+            return cached
+        
+        url = self._url_metrics % job_id
+        response = self.session.get(url)
+        response.raise_for_status()
+        return self._cache_store(key, json_loads(response.content), permanent=True)
+    
+    def get_job_bundle(self, job_id):
+        """
+        Get status, results and metrics of a job in a single request
+        
+        ``results`` and ``metrics`` are None until the job has completed.
+        ``results`` has no ``cell_metrics``, the cells are in ``metrics``.
+        Falls back to the three separate endpoints on servers without
+        ``/bundle/``.
+        """
+        url = self._url_bundle % job_id
         response = self.session.get(url)
+        if response.status_code == 404:
+            status = self.get_job_status(job_id)
+            if status['status'] != 'completed':
+                return {'status': status, 'results': None, 'metrics': None}
+            results = dict(self.get_results(job_id))
+            results.pop('cell_metrics', None)
+            return {'status': status, 'results': results, 'metrics': self.get_metrics(job_id)}
         response.raise_for_status()
-        return response.json()
+        return json_loads(response.content)
     
     def download_file(self, job_id, file_type, output_path):
         """
@@ -70,40 +211,323 @@ class CellposeAPIClient:
             file_type: 'segmented_image', 'individual_cells', 'masks', or 'flows'
             output_path: Where to save the file
         """
-        url = f"{self.base_url}/predictions/{job_id}/download_{file_type}/"
+        url = self._url_download % (job_id, file_type)
         
-        response = self.session.get(url)
-        response.raise_for_status()
-        
-        with open(output_path, 'wb') as f:
-            f.write(response.content)
+        with self.session.get(url, stream=True) as response:
+            response.raise_for_status()
+            with open(output_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
         
         print(f"Downloaded {file_type} to {output_path}")
     
-    def wait_for_completion(self, job_id, timeout=300, poll_interval=5):
+    def wait_for_completion(self, job_id, timeout=300, poll_interval=5, max_interval=30):
         """
         Wait for a job to complete
         
+        Polls every ``poll_interval`` seconds at first and backs off by
+        1.5x (plus jitter) while the status is unchanged, up to
+        ``max_interval``. A status change resets the interval.
+        
         Args:
             job_id: Job ID to wait for
             timeout: Maximum time to wait in seconds
-            poll_interval: How often to check status in seconds
+            poll_interval: Initial time between status checks in seconds
+            max_interval: Longest time between status checks in seconds
         
         Returns:
             dict: Final job status
         """
-        start_time = time.time()
+        deadline = time.monotonic() + timeout
+        interval = poll_interval
+        last_state = None
+        last_print = 0.0
         
-        while time.time() - start_time < timeout:
+        while True:
             status = self.get_job_status(job_id)
             
-            if status['status'] in ['completed', 'failed']:
+            if status['status'] in TERMINAL_STATUSES:
                 return status
             
-            print(f"Job {job_id} status: {status['status']}")
-            time.sleep(poll_interval)
+            now = time.monotonic()
+            remaining = deadline - now
+            if remaining <= 0:
+                raise TimeoutError(f"Job {job_id} did not complete within {timeout} seconds")
+            
+            changed = status['status'] != last_state
+            if changed:
+                last_state = status['status']
+                interval = poll_interval
+            
+            # Report state changes, otherwise only a periodic heartbeat
+            if changed or now - last_print >= STATUS_PRINT_INTERVAL:
+                print(f"Job {job_id} status: {status['status']}")
+                last_print = now
+            time.sleep(min(remaining, interval + random.uniform(0, interval * 0.1)))
+            interval = min(max_interval, interval * 1.5)
+
+    def wait_for_completion_longpoll(self, job_id, timeout=300, hold=30):
+        """
+        Wait for a job to complete using the server's long-poll endpoint
         
-        raise TimeoutError(f"Job {job_id} did not complete within {timeout} seconds")
+        The server holds each ``/wait/`` request for up to ``hold`` seconds
+        and answers as soon as the status changes, so a job takes a few
+        requests instead of one per poll interval. Falls back to
+        wait_for_completion on servers without ``/wait/``.
+        
+        Args:
+            job_id: Job ID to wait for
+            timeout: Maximum time to wait in seconds
+            hold: Longest time the server should hold a single request
+        
+        Returns:
+            dict: Final job status
+        """
+        url = self._url_wait % job_id
+        deadline = time.monotonic() + timeout
+        last_state = None
+        
+        while True:
+            hold_for = max(0, min(hold, deadline - time.monotonic()))
+            params = {'timeout': hold_for}
+            if last_state is not None:
+                params['status'] = last_state
+            
+            response = self.session.get(url, params=params, timeout=hold_for + 10)
+            if response.status_code == 404:
+                return self.wait_for_completion(job_id, timeout=max(0, deadline - time.monotonic()))
+            if response.status_code == 429:
+                # Server has no free long-poll slot, try again after a pause
+                if time.monotonic() >= deadline:
+                    raise TimeoutError(f"Job {job_id} did not complete within {timeout} seconds")
+                retry_after = float(response.headers.get('Retry-After', 2))
+                time.sleep(min(retry_after, max(0, deadline - time.monotonic())))
+                continue
+            response.raise_for_status()
+            status = json_loads(response.content)
+            
+            if status['status'] in TERMINAL_STATUSES:
+                return self._cache_store(('status', job_id), status, permanent=True)
+            
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"Job {job_id} did not complete within {timeout} seconds")
+            
+            if status['status'] != last_state:
+                last_state = status['status']
+                print(f"Job {job_id} status: {last_state}")
+
+
+class AsyncCellposeAPIClient(_EndpointURLs, _ResponseCache):
+    """asyncio client for the Cellpose Django REST API
+    
+    Use as ``async with AsyncCellposeAPIClient() as client:`` so that all
+    requests share one pooled aiohttp session and can run concurrently.
+    """
+    
+    def __init__(self, base_url="http://localhost:8000/api/v1", limit=32):
+        self.base_url = base_url
+        self._build_urls(base_url)
+        self.limit = limit
+        self.session = None
+        self._cache = {}
+    
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.limit, keepalive_timeout=60)
+        self.session = aiohttp.ClientSession(connector=connector)
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+    
+    async def _get_json(self, url):
+        async with self.session.get(url) as response:
+            response.raise_for_status()
+            return json_loads(await response.read())
+    
+    async def submit_image(self, image_path, callback_url=None, **kwargs):
+        """
+        Submit an image for Cellpose prediction
+        
+        Args:
+            image_path: Path to image file
+            callback_url: Optional URL the server POSTs to when the job finishes
+            **kwargs: Additional parameters (diameter, flow_threshold, etc.)
+        
+        Returns:
+            dict: Job information including job ID
+        """
+        url = self._url_submit
+        if callback_url:
+            kwargs['callback_url'] = callback_url
+        
+        with open(image_path, 'rb') as f:
+            form = aiohttp.FormData()
+            form.add_field('input_image', f, filename=os.path.basename(image_path))
+            for key, value in kwargs.items():
+                form.add_field(key, str(value))
+            
+            async with self.session.post(url, data=form) as response:
+                response.raise_for_status()
+                return json_loads(await response.read())
+    
+    async def get_job_status(self, job_id, ttl_ms=0):
+        """Get current status of a prediction job, see CellposeAPIClient.get_job_status"""
+        key = ('status', job_id)
+        cached = self._cache_lookup(key, ttl_ms)
+        if cached is not None:
+            return cached
+        
+        status = await self._get_json(self._url_status % job_id)
+        return self._cache_store(key, status, permanent=status['status'] in TERMINAL_STATUSES)
+    
+    async def get_results(self, job_id):
+        """Get complete results for a completed job"""
+        key = ('results', job_id)
+        cached = self._cache_lookup(key, 0)
+        if cached is not None:
+            return cached
+        
+        results = await self._get_json(self._url_results % job_id)
+        return self._cache_store(key, results, permanent=True)
+    
+    async def get_metrics(self, job_id):
+        """Get detailed metrics for all detected cells"""
+        key = ('metrics', job_id)
+        cached = self._cache_lookup(key, 0)
+        if cached is not None:
+            return cached
+        
+        metrics = await self._get_json(self._url_metrics % job_id)
+        return self._cache_store(key, metrics, permanent=True)
+    
+    async def download_file(self, job_id, file_type, output_path):
+        """
+        Download a result file
+        
+        Args:
+            job_id: Job ID
+            file_type: 'segmented_image', 'individual_cells', 'masks', or 'flows'
+            output_path: Where to save the file
+        """
+        url = self._url_download % (job_id, file_type)
+        
+        async with self.session.get(url) as response:
+            response.raise_for_status()
+            with open(output_path, 'wb') as f:
+                async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+        
+        print(f"Downloaded {file_type} to {output_path}")
+    
+    async def download_all(self, job_id, output_dir,
+                           types=('segmented_image', 'individual_cells', 'masks', 'flows')):
+        """
+        Download several result files of a job concurrently
+        
+        Args:
+            job_id: Job ID
+            output_dir: Directory to save the files in
+            types: File types to download, see download_file
+        
+        Returns:
+            list: Paths of the downloaded files, in the order of ``types``
+        """
+        output_dir = Path(output_dir)
+        paths = []
+        for file_type in types:
+            prefix, ext = DOWNLOAD_FILENAMES[file_type]
+            paths.append(output_dir / f"{prefix}_{job_id}{ext}")
+        
+        await asyncio.gather(*[
+            self.download_file(job_id, file_type, path)
+            for file_type, path in zip(types, paths)
+        ])
+        return paths
+    
+    async def wait_for_completion(self, job_id, timeout=300, poll_interval=5, max_interval=30):
+        """
+        Wait for a job to complete without blocking other coroutines
+        
+        Uses the same backoff as CellposeAPIClient.wait_for_completion.
+        
+        Args:
+            job_id: Job ID to wait for
+            timeout: Maximum time to wait in seconds
+            poll_interval: Initial time between status checks in seconds
+            max_interval: Longest time between status checks in seconds
+        
+        Returns:
+            dict: Final job status
+        """
+        deadline = time.monotonic() + timeout
+        interval = poll_interval
+        last_state = None
+        last_print = 0.0
+        
+        while True:
+            status = await self.get_job_status(job_id)
+            
+            if status['status'] in TERMINAL_STATUSES:
+                return status
+            
+            now = time.monotonic()
+            remaining = deadline - now
+            if remaining <= 0:
+                raise TimeoutError(f"Job {job_id} did not complete within {timeout} seconds")
+            
+            changed = status['status'] != last_state
+            if changed:
+                last_state = status['status']
+                interval = poll_interval
+            
+            # Report state changes, otherwise only a periodic heartbeat
+            if changed or now - last_print >= STATUS_PRINT_INTERVAL:
+                print(f"Job {job_id} status: {status['status']}")
+                last_print = now
+            await asyncio.sleep(min(remaining, interval + random.uniform(0, interval * 0.1)))
+            interval = min(max_interval, interval * 1.5)
+
+    async def wait_for_completion_longpoll(self, job_id, timeout=300, hold=30):
+        """
+        Wait for a job to complete using the server's long-poll endpoint
+        
+        See CellposeAPIClient.wait_for_completion_longpoll.
+        """
+        url = self._url_wait % job_id
+        deadline = time.monotonic() + timeout
+        last_state = None
+        
+        while True:
+            hold_for = max(0, min(hold, deadline - time.monotonic()))
+            params = {'timeout': hold_for}
+            if last_state is not None:
+                params['status'] = last_state
+            
+            request_timeout = aiohttp.ClientTimeout(total=hold_for + 10)
+            async with self.session.get(url, params=params, timeout=request_timeout) as response:
+                if response.status == 404:
+                    return await self.wait_for_completion(job_id, timeout=max(0, deadline - time.monotonic()))
+                retry_after = float(response.headers.get('Retry-After', 2)) if response.status == 429 else None
+                if retry_after is None:
+                    response.raise_for_status()
+                    status = json_loads(await response.read())
+            
+            if retry_after is not None:
+                # Server has no free long-poll slot, try again after a pause
+                if time.monotonic() >= deadline:
+                    raise TimeoutError(f"Job {job_id} did not complete within {timeout} seconds")
+                await asyncio.sleep(min(retry_after, max(0, deadline - time.monotonic())))
+                continue
+            
+            if status['status'] in TERMINAL_STATUSES:
+                return self._cache_store(('status', job_id), status, permanent=True)
+            
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"Job {job_id} did not complete within {timeout} seconds")
+            
+            if status['status'] != last_state:
+                last_state = status['status']
+                print(f"Job {job_id} status: {last_state}")
 
 
 def main():
@@ -143,15 +567,15 @@ def main():
             print(f"   Cells detected: {final_status['num_cells_detected']}")
             print(f"   Processing time: {final_status['processing_time']:.2f}s")
             
-            # Get detailed results
-            results = client.get_results(job_id)
+            # Get detailed results and metrics in one round trip
+            bundle = client.get_job_bundle(job_id)
+            results = bundle['results']
+            metrics = bundle['metrics']
             print(f"\n📊 Results:")
             print(f"   Masks file: {results['result_masks']}")
             print(f"   Segmented image: {results['result_segmented_images']}")
             print(f"   Individual cells: {results['result_tif_archive']}")
             
-            # Get metrics
-            metrics = client.get_metrics(job_id)
             print(f"\n📈 Metrics Summary:")
             summary = metrics['summary']
             print(f"   Total cells: {summary['total_cells']}")
@@ -164,19 +588,8 @@ def main():
             
             print(f"\n⬇️  Downloading results to {output_dir}/")
             
-            # Download segmented image
-            client.download_file(
-                job_id, 
-                'segmented_image', 
-                output_dir / f"segmented_{job_id}.png"
-            )
-            
-            # Download individual cells ZIP
-            client.download_file(
-                job_id, 
-                'individual_cells', 
-                output_dir / f"individual_cells_{job_id}.zip"
-            )
+            # Download segmented image, individual cells ZIP, masks and flows
+            asyncio.run(_download_results(client.base_url, job_id, output_dir))
             
             # Show first few cell metrics
             print(f"\n🔬 Individual Cell Metrics (first 5):")
@@ -186,8 +599,8 @@ def main():
                       f"aspect_ratio={cell['aspect_ratio']:.2f}, "
                       f"eccentricity={cell['eccentricity']:.2f}")
             
-            if len(metrics['individual_metrics']) > 5:
-                print(f"   ... and {len(metrics['individual_metrics']) - 5} more cells")
+            if summary['total_cells'] > 5:
+                print(f"   ... and {summary['total_cells'] - 5} more cells")
             
             print(f"\n✨ All done! Check the {output_dir}/ directory for results.")
             
@@ -198,10 +611,46 @@ def main():
         print(f"❌ Error: {str(e)}")
 
 
+async def _download_results(base_url, job_id, output_dir):
+    """Fetch all result files of a job in parallel over one aiohttp session"""
+    async with AsyncCellposeAPIClient(base_url) as client:
+        return await client.download_all(job_id, output_dir)
+
+
 def batch_example():
     """Example of processing multiple images"""
+    asyncio.run(_batch_example())
+
+
+async def _process_one(client, semaphore, image_path):
+    """Submit one image, wait for it and fetch its metrics
     
-    client = CellposeAPIClient()
+    Returns:
+        tuple: (job_id, number of cells), the count is None if the job
+        failed or timed out
+    """
+    async with semaphore:
+        job = await client.submit_image(image_path)
+        job_id = job['id']
+        print(f"Submitted {image_path} -> Job {job_id}")
+        
+        try:
+            status = await client.wait_for_completion(job_id)
+        except TimeoutError:
+            print(f"⏰ Job {job_id} timed out")
+            return job_id, None
+        
+        if status['status'] != 'completed':
+            print(f"❌ Job {job_id} failed")
+            return job_id, None
+        print(f"✅ Job {job_id} completed")
+        
+        metrics = await client.get_metrics(job_id)
+        return job_id, metrics['summary']['total_cells']
+
+
+async def _batch_example():
+    """Run every image through submit, wait and metrics as its own pipeline"""
     
     # List of images to process
     image_paths = [
@@ -209,37 +658,23 @@ def batch_example():
         "image2.png", 
         "image3.png"
     ]
+    # Check the files off the event loop, all at once
+    exists = await asyncio.gather(*[asyncio.to_thread(os.path.exists, p) for p in image_paths])
+    image_paths = [p for p, found in zip(image_paths, exists) if found]
     
-    # Submit all jobs
-    job_ids = []
-    for image_path in image_paths:
-        if os.path.exists(image_path):
-            job = client.submit_image(image_path)
-            job_ids.append(job['id'])
-            print(f"Submitted {image_path} -> Job {job['id']}")
-    
-    # Wait for all to complete
-    completed_jobs = []
-    for job_id in job_ids:
-        try:
-            status = client.wait_for_completion(job_id)
-            if status['status'] == 'completed':
-                completed_jobs.append(job_id)
-                print(f"✅ Job {job_id} completed")
-            else:
-                print(f"❌ Job {job_id} failed")
-        except TimeoutError:
-            print(f"⏰ Job {job_id} timed out")
+    # Bound the number of jobs in flight so a large batch does not swamp the server
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    async with AsyncCellposeAPIClient() as client:
+        results = await asyncio.gather(
+            *[_process_one(client, semaphore, p) for p in image_paths]
+        )
     
-    # Get summary statistics
-    total_cells = 0
-    for job_id in completed_jobs:
-        metrics = client.get_metrics(job_id)
-        cells = metrics['summary']['total_cells']
-        total_cells += cells
+    completed = [(job_id, cells) for job_id, cells in results if cells is not None]
+    for job_id, cells in completed:
         print(f"Job {job_id}: {cells} cells detected")
     
-    print(f"\n📊 Batch Summary: {total_cells} total cells across {len(completed_jobs)} images")
+    total_cells = sum(cells for _, cells in completed)
+    print(f"\n📊 Batch Summary: {total_cells} total cells across {len(completed)} images")
 
 
 if __name__ == "__main__":
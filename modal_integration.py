@@ -31,6 +31,10 @@ def receive_cellpose_results(data: Dict[str, Any]):
         "masks_shape": [1024, 1024],
         "processing_time": 15.3
     }
+    
+    When this endpoint is registered as a job's ``callback_url`` the payload
+    has "status" and "error_message" instead of "masks_shape", and
+    "num_cells" is null for failed jobs.
     """
     
     print(f"Received Cellpose results for job: {data.get('job_id')}")
@@ -68,6 +72,10 @@ def process_results(data: Dict[str, Any]):
     num_cells = data.get('num_cells')
     processing_time = data.get('processing_time')
     
+    if data.get('status') == 'failed':
+        print(f"Job {job_id} failed: {data.get('error_message')}")
+        return
+    
     # Example processing:
     if num_cells > 100:
         print(f"High cell count detected in job {job_id}: {num_cells} cells")